@@ -10,6 +10,8 @@
 # - Demo checkout that saves orders locally (orders.json)
 # - Admin page (optional password) to add/edit/deactivate products
 # - Export products + orders to CSV
+# - "Frequently bought together" + "Popular in this category" suggestions from order history
+# - Carts saved server-side (data/carts) under a ?cart= URL token, so a refresh keeps them
 #
 # Deploy on Streamlit Community Cloud:
 # - Put this file in a GitHub repo as streamlit_app.py
@@ -17,10 +19,14 @@
 # - In Streamlit Cloud, set Main file path: streamlit_app.py
 # - Optional secret: ADMIN_PASSWORD
 
+import atexit
 import json
 import os
+import threading
+import time
 import uuid
 from datetime import datetime
+from itertools import zip_longest
 
 import pandas as pd
 import streamlit as st
@@ -29,6 +35,11 @@ APP_NAME = "Grandparent Assist Shop"
 DATA_DIR = "data"
 PRODUCTS_PATH = os.path.join(DATA_DIR, "products.json")
 ORDERS_PATH = os.path.join(DATA_DIR, "orders.json")
+CARTS_DIR = os.path.join(DATA_DIR, "carts")
+
+CART_TTL_SECONDS = 14 * 24 * 60 * 60  # abandoned carts expire after two weeks
+CART_SAVE_DELAY = 2.0  # seconds to wait so rapid quantity changes become one write
+RECOMMEND_TOP_K = 3
 
 CATEGORIES = ["T-Shirts", "Coloring Books", "Calendar", "Bags", "Mugs"]
 
@@ -289,19 +300,288 @@ def cart_flat(cart: dict, products: list):
     return rows
 
 
+# ---------- Cart persistence ----------
+def cart_encode(cart: dict) -> str:
+    # Compact form: [[product_id, variant, qty], ...] — the cart key is rebuilt on load
+    rows = [[item["product_id"], item.get("variant", ""), int(item["qty"])] for item in cart.values()]
+    return json.dumps(rows, ensure_ascii=False, separators=(",", ":"))
+
+
+def cart_decode(raw: str) -> dict:
+    cart = {}
+    for pid, variant, qty in json.loads(raw):
+        cart[f"{pid}::{variant}"] = {"product_id": pid, "variant": variant, "qty": int(qty)}
+    return cart
+
+
+def valid_cart_token(token: str) -> bool:
+    # Tokens come from the URL and become file names, so only accept uuid4().hex
+    return len(token) == 32 and all(c in "0123456789abcdef" for c in token)
+
+
+class CartStore:
+    """Server-side carts: one small file per token, debounced writes, TTL expiry."""
+
+    def __init__(self, root: str, ttl: float, delay: float):
+        self.root = root
+        self.ttl = ttl
+        self.delay = delay
+        self._pending = {}  # token -> encoded cart waiting to be written
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # one flush at a time: shared temp names, ordered writes
+        self._timer = None
+        self._last_prune = 0.0
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, token: str) -> str:
+        return os.path.join(self.root, f"{token}.json")
+
+    def load(self, token: str) -> dict:
+        # Held for the whole lookup so prune() can't delete the file between the TTL check and the read
+        with self._lock:
+            raw = self._pending.get(token)
+            if raw is not None:
+                return cart_decode(raw)
+
+            path = self._path(token)
+            try:
+                if time.time() - os.path.getmtime(path) > self.ttl:
+                    os.remove(path)
+                    return {}
+                with open(path, "r", encoding="utf-8") as f:
+                    cart = cart_decode(f.read())
+                os.utime(path)  # a returning shopper resets the expiry clock
+                return cart
+            except (OSError, ValueError, TypeError):
+                return {}
+
+    def save(self, token: str, cart: dict):
+        raw = cart_encode(cart)
+        with self._lock:
+            self._pending[token] = raw
+            self._arm()
+
+    def _arm(self):
+        # Caller holds self._lock
+        if self._timer is None:
+            self._timer = threading.Timer(self.delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending = dict(self._pending)
+                self._timer = None
+
+            failed = False
+            for token, raw in pending.items():
+                path = self._path(token)
+                try:
+                    if raw == "[]":
+                        if os.path.exists(path):
+                            os.remove(path)
+                    else:
+                        tmp = f"{path}.tmp"
+                        with open(tmp, "w", encoding="utf-8") as f:
+                            f.write(raw)
+                        os.replace(tmp, path)
+                except OSError:
+                    failed = True  # stays pending, so load() still serves it and the write is retried
+                    continue
+                # Keep any newer save that arrived meanwhile for the next flush
+                with self._lock:
+                    if self._pending.get(token) == raw:
+                        del self._pending[token]
+
+            if failed:
+                with self._lock:
+                    self._arm()
+
+        self.prune()
+
+    def prune(self):
+        with self._lock:
+            now = time.time()
+            if now - self._last_prune < 60 * 60:
+                return
+            self._last_prune = now
+        cutoff = now - self.ttl
+        try:
+            entries = list(os.scandir(self.root))
+        except OSError:
+            return
+        for entry in entries:
+            if not entry.name.endswith(".json"):
+                continue
+            with self._lock:
+                try:
+                    if entry.name[: -len(".json")] not in self._pending and os.path.getmtime(entry.path) < cutoff:
+                        os.remove(entry.path)
+                except OSError:
+                    pass
+
+
+@st.cache_resource
+def get_cart_store() -> CartStore:
+    store = CartStore(CARTS_DIR, CART_TTL_SECONDS, CART_SAVE_DELAY)
+    store.prune()
+    atexit.register(store.flush)
+    return store
+
+
+def get_cart_token() -> str:
+    token = st.query_params.get("cart", "")
+    if not valid_cart_token(token):
+        token = uuid.uuid4().hex
+        st.query_params["cart"] = token
+    return token
+
+
+def persist_cart():
+    # Only queue a write when the cart actually changed since the last save
+    raw = cart_encode(st.session_state.cart)
+    if raw != st.session_state.cart_saved:
+        get_cart_store().save(st.session_state.cart_token, st.session_state.cart)
+        st.session_state.cart_saved = raw
+
+
+# ---------- Recommendations ----------
+class Recommender:
+    """Item co-occurrence over order history with precomputed top-k lists.
+
+    The sparse matrix is a dict of dicts (product_id -> {other_id: orders}).
+    The initial build counts everything and ranks once; after that a new order
+    re-ranks only the rows it touches. Queries only read the precomputed lists,
+    so a rerun never touches the matrix.
+    """
+
+    # Orders counted per lock hold, so a checkout during the build waits for one
+    # chunk rather than the whole count (the final ranking is still one lock hold)
+    BUILD_CHUNK = 1000
+
+    def __init__(self, k: int):
+        self.k = k
+        self._pairs = {}  # pid -> {other pid: number of orders with both}
+        self._popular = {}  # category -> {pid: units sold}
+        # Lists below are never mutated, only replaced, so readers don't need the lock
+        self._together = {}  # pid -> [(other pid, orders with both)], best first
+        self._top_in_category = {}  # category -> [(pid, units sold)], best first
+        self._lock = threading.Lock()
+
+    def start(self, orders: list):
+        # Initial build runs off the script thread so the first page render isn't blocked.
+        # Copy the list so checkouts appending to it can't race the iteration.
+        threading.Thread(target=self._build, args=(list(orders),), daemon=True).start()
+
+    def _build(self, orders: list):
+        for i in range(0, len(orders), self.BUILD_CHUNK):
+            with self._lock:
+                for order in orders[i : i + self.BUILD_CHUNK]:
+                    self._count(order)
+        with self._lock:
+            self._together = {pid: self._top(row) for pid, row in self._pairs.items() if row}
+            self._top_in_category = {cat: self._top(counts) for cat, counts in self._popular.items()}
+
+    def _count(self, order: dict) -> dict:
+        """Add one order to the counts; returns {product_id: category} for the products it touched."""
+        try:
+            lines = [
+                (it["product_id"], it.get("category"), int(it.get("qty", 1) or 1))
+                for it in order.get("items", [])
+                if it.get("product_id")
+            ]
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return {}  # malformed order: skip it rather than leave it half-counted
+
+        categories = {}
+        for pid, cat, qty in lines:
+            categories[pid] = cat
+            if cat:
+                counts = self._popular.setdefault(cat, {})
+                counts[pid] = counts.get(pid, 0) + qty
+
+        pids = list(categories)
+        for a in pids:
+            row = self._pairs.setdefault(a, {})
+            for b in pids:
+                if a != b:
+                    row[b] = row.get(b, 0) + 1
+        return categories
+
+    def add_order(self, order: dict):
+        with self._lock:
+            categories = self._count(order)
+            if len(categories) > 1:
+                for pid in categories:
+                    self._together[pid] = self._top(self._pairs[pid])
+            for cat in {c for c in categories.values() if c}:
+                self._top_in_category[cat] = self._top(self._popular[cat])
+
+    def _top(self, counts: dict) -> list:
+        ranked = sorted(counts.items(), key=lambda kv: (-kv[1], kv[0]))
+        return ranked[: self.k * 3]  # headroom for inactive/in-cart filtering
+
+    def together(self, pid: str) -> list:
+        return [other for other, _ in self._together.get(pid, [])]
+
+    def together_with(self, pids) -> list:
+        # Merge the precomputed lists of a set of products (e.g. the cart), summing
+        # each candidate's co-occurrence counts across the lists it appears in
+        scores = {}
+        for pid in pids:
+            for other, n in self._together.get(pid, []):
+                scores[other] = scores.get(other, 0) + n
+        for pid in pids:
+            scores.pop(pid, None)
+        return sorted(scores, key=lambda other: (-scores[other], other))
+
+    def popular(self, category: str) -> list:
+        return [pid for pid, _ in self._top_in_category.get(category, [])]
+
+
+@st.cache_resource
+def get_recommender(_orders: list) -> Recommender:
+    # Seeded from the orders already in memory; the leading underscore keeps
+    # Streamlit from hashing the whole order list on every rerun
+    engine = Recommender(RECOMMEND_TOP_K)
+    engine.start(_orders)
+    return engine
+
+
+def pick_products(pids, by_id: dict, exclude=(), k: int = RECOMMEND_TOP_K):
+    picked, seen = [], set(exclude)
+    for pid in pids:
+        p = by_id.get(pid)
+        if p and p.get("active", True) and pid not in seen:
+            seen.add(pid)
+            picked.append(p)
+            if len(picked) == k:
+                break
+    return picked
+
+
+def suggestion_line(label: str, picks: list):
+    if picks:
+        st.caption(f"**{label}:** " + " · ".join(f"{p['name']} ({money(float(p['price']))})" for p in picks))
+
+
 # ---------- Streamlit setup ----------
 st.set_page_config(page_title=APP_NAME, page_icon="🛍️", layout="wide")
 
+if "cart" not in st.session_state:
+    # cart key = f"{product_id}::{variant}"
+    # Restored before the catalog/orders load: a single file read by token
+    st.session_state.cart_token = get_cart_token()
+    st.session_state.cart = get_cart_store().load(st.session_state.cart_token)
+    st.session_state.cart_saved = cart_encode(st.session_state.cart)
+
 if "products" not in st.session_state:
     st.session_state.products = load_json(PRODUCTS_PATH, DEFAULT_PRODUCTS)
 
 if "orders" not in st.session_state:
     st.session_state.orders = load_json(ORDERS_PATH, [])
 
-if "cart" not in st.session_state:
-    # cart key = f"{product_id}::{variant}"
-    st.session_state.cart = {}
-
 if "admin_ok" not in st.session_state:
     st.session_state.admin_ok = False
 
@@ -348,6 +628,10 @@ def page_shop():
         st.info("No products found.")
         return
 
+    engine = get_recommender(orders)
+    by_id = {p["id"]: p for p in products}
+    suggestion_line(f"Popular in {category}", pick_products(engine.popular(category), by_id))
+
     grid = st.columns(2)
     for i, p in enumerate(visible):
         with grid[i % 2]:
@@ -369,6 +653,8 @@ def page_shop():
                     st.write(p.get("details", ""))
                     st.write("**Variants:** " + ", ".join(p.get("variants", [])))
 
+                suggestion_line("Frequently bought together", pick_products(engine.together(p["id"]), by_id, exclude=[p["id"]]))
+
                 variant = st.selectbox(
                     "Choose variant",
                     p.get("variants", ["Default"]) or ["Default"],
@@ -408,6 +694,17 @@ def page_cart():
     df = pd.DataFrame(rows)
     st.dataframe(df[["name", "category", "variant", "qty", "unit_price", "line_total"]], use_container_width=True)
 
+    engine = get_recommender(orders)
+    by_id = {p["id"]: p for p in products}
+    in_cart = [r["product_id"] for r in rows]
+    together = engine.together_with(set(in_cart))
+    # Interleave the categories' lists so a mixed cart gets picks from each of them
+    cats = list(dict.fromkeys(r["category"] for r in rows))
+    popular = [pid for group in zip_longest(*(engine.popular(c) for c in cats)) for pid in group if pid]
+    label = f"Popular in {cats[0]}" if len(cats) == 1 else "Popular in these categories"
+    suggestion_line("Frequently bought together", pick_products(together, by_id, exclude=in_cart))
+    suggestion_line(label, pick_products(popular, by_id, exclude=in_cart))
+
     st.subheader("Update quantities")
     for r in rows:
         cols = st.columns([5, 2, 2])
@@ -467,8 +764,12 @@ def page_cart():
             "notes": notes.strip(),
         }
 
+        # Fetch the engine before appending: if this call creates it, its seed must
+        # not already contain the order that add_order is about to count
+        engine = get_recommender(st.session_state.orders)
         st.session_state.orders.append(order)
         save_json(ORDERS_PATH, st.session_state.orders)
+        engine.add_order(order)
         st.session_state.cart = {}
         st.success(f"Order saved! Order ID: {order_id}")
 
@@ -681,5 +982,7 @@ elif page == "Admin":
 elif page == "Export":
     page_export()
 
+persist_cart()
+
 st.sidebar.divider()
 st.sidebar.caption("Deploy tip: add `ADMIN_PASSWORD` in Streamlit Secrets for the Admin page.")